@@ -2,9 +2,12 @@
 
 from PIL import Image, ImageDraw
 import numpy as np
+from numba import njit
 import sys
-from sys import argv
-from os import makedirs
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os import makedirs, cpu_count
 from os.path import isdir, isfile
 
 BLANK = np.array((0, 0, 0, 0))
@@ -21,86 +24,123 @@ DEFAULT_FORMAT = Format.GIF
 
 TEST_LINE = False
 
+# interpolation is done in fixed point with this many fractional bits
+FRACTION_BITS = 16
+
+# offsets to the 8 neighbours of a pixel, clockwise starting from the top
+DI = np.array((-1, -1, 0, 1, 1, 1, 0, -1), dtype=np.int8)
+DJ = np.array((0, 1, 1, 1, 0, -1, -1, -1), dtype=np.int8)
+
 def eprint(*args, **kwargs):
     """Print to stderr"""
     print(*args, file=sys.stderr, **kwargs)
 
-def debug_line(line, width, height):
-    """Open a debug pyglet window that draws a given line in a window of size width x height."""
-    import pyglet 
+if TEST_LINE:
+    import pyglet
     from pyglet import shapes
 
-    window = pyglet.window.Window(width, height)
-    pyglet.gl.glClearColor(1,1,1,1)
+    def debug_line(line, width, height):
+        """Open a debug pyglet window that draws a given line in a window of size width x height."""
+        window = pyglet.window.Window(width, height)
+        pyglet.gl.glClearColor(1,1,1,1)
+
+        batch = pyglet.graphics.Batch()
 
-    batch = pyglet.graphics.Batch()
+        point = 0
+        circles = []
 
-    point = 0
-    circles = []
+        @window.event
+        def on_draw():
+            window.clear()
+            batch.draw()
 
-    @window.event
-    def on_draw():
-        window.clear()
-        batch.draw()
+        def callback(_):
+            nonlocal point
+            i, j = line[point]
+            circles.append(shapes.Circle(j, window.height - i, 3, color=(0x9f, 0x34, 0xb9), batch=batch))
+            point += 1
 
-    def callback(_):
-        nonlocal point
-        i, j = line[point]
-        circles.append(shapes.Circle(j, window.height - i, 3, color=(0x9f, 0x34, 0xb9), batch=batch))
-        point += 1
+            if point == len(line):
+                pyglet.clock.unschedule(callback)
 
-        if point == len(line):
-            pyglet.clock.unschedule(callback)
 
+        pyglet.clock.schedule_interval(callback, 0.01)
+        pyglet.app.run()
 
-    pyglet.clock.schedule_interval(callback, 0.01)
-    pyglet.app.run()
+def find_first(alpha):
+    """Find the location of the first non-empty pixel of an alpha plane searching from top to bottom"""
+    flat = alpha.ravel()
+    idx = int(np.argmax(flat != 0))
+    if not flat[idx]:
+        return len(alpha), len(alpha[0])
+    return divmod(idx, len(alpha[0]))
 
-def find_first(pic):
-    """Find the location of the first non-empty pixel searching from top to bottom"""
-    for i in range(len(pic)):
-        for j in range(len(pic[0])):
-            if pic[i][j][3] != 0:
-                return (i, j)
-    return len(pic), len(pic[0])
+@njit(cache=True)
+def _trace(border, i0, j0, height, width):
+    """Trace the border of the shape in the border mask clockwise starting from (i0, j0).
+    Returns the i and j coordinates of the line and whether the tracing succeeded
+    """
+    line_i = np.empty(height * width, dtype=np.int32)
+    line_j = np.empty(height * width, dtype=np.int32)
+    n = 0
+    # ring buffer of the last 8 points so that the tracer does not step back
+    prevs_i = np.full(8, height, dtype=np.int32)
+    prevs_j = np.full(8, width, dtype=np.int32)
+    head = 0
+    i, j = i0, j0
+    while True:
+        found = False
+        for d in range(8):
+            ni = i + DI[d]
+            nj = j + DJ[d]
+            if border[ni, nj]:
+                seen = False
+                for k in range(8):
+                    if prevs_i[k] == ni and prevs_j[k] == nj:
+                        seen = True
+                        break
+                if not seen:
+                    found = True
+                    break
+        if not found or n == line_i.size:
+            return line_i[:n], line_j[:n], False
+
+        i, j = ni, nj
+        line_i[n] = i
+        line_j[n] = j
+        n += 1
+        prevs_i[head] = i
+        prevs_j[head] = j
+        head = (head + 1) % 8
+
+        if i == i0 and j == j0:
+            return line_i[:n], line_j[:n], True
 
 def get_line(path):
     """Returns a list of points on an image that make up a line around the border of a monotonous image.
     The 'outside' of the object is expected to have alpha of 0
     """
-    original = np.array(Image.open(path))
-    height = len(original)
-    width = len(original[0])
-
-    col = np.zeros((height, 1, 4), dtype=np.uint8)
-    padded = np.hstack((col, original, col))
-    width += 2
-
-    row = np.zeros((1, width, 4), dtype=np.uint8)
-    padded = np.vstack((row, padded, row))
-    height += 2
+    original = Image.open(path)
+    # only the alpha channel is needed to trace the border
+    padded = np.pad(np.asarray(original.getchannel('A')), 1)
+    height = len(padded)
+    width = len(padded[0])
 
     first = find_first(padded)
     i, j = first
-    color = tuple(padded[i][j])
-    prevs = [(height, width)] * 8
-    line = []
-    while True:
-        for i, j in ((i - 1, j), (i - 1, j + 1), (i, j + 1), (i + 1, j + 1), (i + 1, j), (i + 1, j - 1), (i, j - 1), (i - 1, j - 1)):
-            if padded[i][j][3] != 0 and any(x == 0 for x in (padded[i - 1][j][3], padded[i][j + 1][3],  padded[i + 1][j][3], padded[i][j - 1][3])) and \
-                    (i, j) not in prevs:
-                line.append((i, j))
-                prevs.pop(0)
-                prevs.append((i, j))
-                break
-        else:
-            eprint(f'ERROR: border could not be traced for {path}. Make sure you provided a picture without any holes')
-            if TEST_LINE:
-                debug_line(line, width, height)
-            exit(1)
-
-        if (i, j) == first:
-            break
+    # the padding shifts every pixel by one
+    color = original.getpixel((j - 1, i - 1))
+    # a pixel is on the border if it is not empty and at least one of its 4 neighbours is
+    filled = padded != 0
+    inner = np.roll(filled, 1, 0) & np.roll(filled, -1, 0) & np.roll(filled, 1, 1) & np.roll(filled, -1, 1)
+    border = (filled & ~inner).view(np.uint8)
+    line_i, line_j, ok = _trace(border, i, j, height, width)
+    line = list(zip(line_i.tolist(), line_j.tolist()))
+    if not ok:
+        eprint(f'ERROR: border could not be traced for {path}. Make sure you provided a picture without any holes')
+        if TEST_LINE:
+            debug_line(line, width, height)
+        exit(1)
 
     if TEST_LINE:
         debug_line(line, width, height)
@@ -125,115 +165,86 @@ def get_line(path):
     '''
     return line, color, (width, height)
 
-def flood_fill(img, xy, color):
-    """Flood fill a PIL image img starting from tuple point xy with a given color"""
-    stack = []
-    stack.append(xy)
-    while stack:
-        n = stack.pop()
-        x, y = n
-        if 0 <= x < img.width and 0 <= y < img.height and img.getpixel(n) == (255, 255, 255, 255):
-            img.putpixel(n, color)
-            stack.append((x - 1, y))
-            stack.append((x + 1, y))
-            stack.append((x, y - 1))
-            stack.append((x, y + 1))
-        
-
-def lerp(a: float, b: float, t: float) -> float:
-    """Linear interpolate on the scale given by a to b, using t as the point on that scale."""
-    return (1 - t) * a + t * b
-
-
-def help(program):
-    print(f"Usage: {program} FROM TO [OPTION]")
-    print("Create morph animation from one closed shape to another.")
-    print("For formats other than gif all frames are output.")
-    print()
-    print("Options:")
-    print("-o <path>                            path to the output GIF or an output")
-    print("                                       directory for frames for other formats")
-    print(f"-n<frames>                           set the number of frames; default is {DEFAULT_NFRAMES}")
-    print(f"-d<seconds>, --duration=<seconds>    set the duration of a GIF in secodns; default is {DEFAULT_DURATION}")
-    print(f"-f<format>                           set the output format; default is {str(DEFAULT_FORMAT)[7:]}")
-    print("-l<times>, --loop<times>              a number of loops for a GIF animation; default is 0 (meaning loop indefinitely)")
-    print("-h                                   print this help message and exit")
-    exit(0)
+def render_frame(t, color, start, delta, size, mode="RGBA", background="white", palette=None):
+    """Render the frame at point t of the morph filled with color as an image of a given size and mode.
+    t is a fixed point number with FRACTION_BITS fractional bits.
+    start and delta are integer arrays of (x, y) points of the original line and the offsets to the final line.
+    For 'P' mode, a palette image has to be given and color and background are indices in its palette
+    """
+    interpolated = list(map(tuple, (start + (delta * t >> FRACTION_BITS)).tolist()))
+
+    img = Image.new(mode, size, background)
+    if palette is not None:
+        img.putpalette(palette.getpalette())
+    draw = ImageDraw.Draw(img)
+    draw.polygon(interpolated, fill=color, outline=color)
+    return img
+
+def write_frame(path, t, color, **kwargs):
+    """Render a frame with render_frame and save it to path"""
+    render_frame(t, color, **kwargs).save(path)
+
+def shared_palette(colors):
+    """Returns a 'P' mode image with a palette of at most 256 colors covering the background and the given fill colors.
+    Pixel 0 of the image is the index of the white background and pixel k + 1 is the index of colors[k]
+    """
+    strip = Image.new("RGB", (len(colors) + 1, 1))
+    strip.putdata([(255, 255, 255)] + colors)
+    return strip.quantize(colors=256)
+
+def positive_int(s):
+    """Parse a positive integer command line argument"""
+    value = int(s)
+    if value <= 0:
+        raise ArgumentTypeError(f'a positive number expected, got `{s}`')
+    return value
+
+def positive_float(s):
+    """Parse a positive float command line argument"""
+    value = float(s)
+    if value <= 0:
+        raise ArgumentTypeError(f'a positive number expected, got `{s}`')
+    return value
+
+def loop_count(s):
+    """Parse a number of GIF loops; -1 disables looping and 0 loops indefinitely"""
+    value = int(s)
+    if value < -1:
+        raise ArgumentTypeError(f'a valid loop number expected, got `{s}`')
+    return value
+
+def make_parser():
+    """Returns the command line argument parser"""
+    parser = ArgumentParser(usage='%(prog)s FROM TO [OPTION]',
+                            description='Create morph animation from one closed shape to another. '
+                                        'For formats other than gif all frames are output.')
+    parser.add_argument('original_path', metavar='FROM', help='image of the original shape')
+    parser.add_argument('final_path', metavar='TO', help='image of the final shape')
+    parser.add_argument('-o', dest='output_path', metavar='<path>', default='',
+                        help='path to the output GIF or an output directory for frames for other formats')
+    parser.add_argument('-n', dest='nframes', metavar='<frames>', type=positive_int, default=DEFAULT_NFRAMES,
+                        help=f'set the number of frames; default is {DEFAULT_NFRAMES}')
+    parser.add_argument('-d', '--duration', metavar='<seconds>', type=positive_float, default=DEFAULT_DURATION,
+                        help=f'set the duration of a GIF in seconds; default is {DEFAULT_DURATION}')
+    parser.add_argument('-f', dest='format', metavar='<format>', choices=[f.name.lower() for f in Format],
+                        default=DEFAULT_FORMAT.name.lower(),
+                        help=f'set the output format; default is {DEFAULT_FORMAT.name}')
+    parser.add_argument('--gif', dest='format', action='store_const', const='gif', help='same as -fgif')
+    parser.add_argument('-l', '--loop', metavar='<times>', type=loop_count, default=0,
+                        help='a number of loops for a GIF animation; default is 0 (meaning loop indefinitely)')
+    return parser
 
 def main():
+    parser = make_parser()
+    args = parser.parse_args()
 
-    program = argv.pop(0)
-
-    original_path = ''
-    final_path = ''
-    output_path = ''
-    nframes = DEFAULT_NFRAMES
-    duration = DEFAULT_DURATION
-    format = DEFAULT_FORMAT
-    loop = 0
-
-    while argv:
-        arg = argv.pop(0)
-        if arg == "-o":
-            if len(argv) > 0:
-                output_path = argv.pop(0)
-            else:
-                eprint(f'{program}: error: missing directory name after `-o`')
-                exit(1)
-        elif arg.startswith("-n"):
-            try:
-                nframes = int(arg[2:])
-                assert nframes > 0
-            except (ValueError, AssertionError):
-                eprint(f'{program}: error: a positive number of frames should be provided after `-n`')
-                exit(1)
-        elif arg.startswith("-d"):
-            try:
-                duration = float(arg[2:])
-                assert duration > 0
-            except (ValueError, AssertionError):
-                eprint(f'{program}: error: a positive duration in seconds should be provided after `-d`')
-                exit(1)
-        elif arg.startswith("--duration="):
-            try:
-                duration = float(arg[11:])
-                assert duration > 0
-            except (ValueError, AssertionError):
-                eprint(f'{program}: error: a positive duration in seconds should be provided after `--duration=`')
-                exit(1)
-        elif arg.startswith("--loop="):
-            try:
-                loop = int(arg[7:])
-                assert loop >= -1
-            except (ValueError, AssertionError):
-                eprint(f'{program}: error: a valid loop number should be provided after `--loop=`')
-                exit(1)
-        elif arg.startswith("-l"):
-            try:
-                loop = int(arg[2:])
-                assert loop >= -1
-            except (ValueError, AssertionError):
-                eprint(f'{program}: error: a valid loop number should be provided after `-l`')
-                exit(1)
-
-        elif arg == "--gif":
-            format = Format.GIF
-        elif arg.startswith('-f'):
-            s = arg[2:]
-            if s == 'gif': format = Format.GIF
-            elif s == 'png': format = Format.PNG
-            elif s == 'jpeg': format = Format.JPEG
-        elif arg == "-h" or arg == "--help":
-            help(program)
-        else:
-            if original_path:
-                final_path = arg
-            else:
-                original_path = arg
-
-    if not original_path or not final_path:
-        eprint(f'{program}: error: no input files')
-        exit(1)
+    original_path = args.original_path
+    final_path = args.final_path
+    output_path = args.output_path
+    nframes = args.nframes
+    duration = args.duration
+    format = Format[args.format.upper()]
+    loop = args.loop
 
     if not output_path:
         if format == Format.GIF:
@@ -242,12 +253,10 @@ def main():
             output_path = 'res'
 
     if isfile(output_path) and format != Format.GIF:
-        eprint(f'{program}: error: `{output_path}` is not a directory')
-        exit(1)
+        parser.error(f'`{output_path}` is not a directory')
 
     if isdir(output_path) and format == Format.GIF:
-        eprint(f'{program}: error: `{output_path}` is a directory')
-        exit(1)
+        parser.error(f'`{output_path}` is a directory')
 
     if not isdir(output_path) and format != Format.GIF:
         makedirs(output_path)
@@ -258,54 +267,47 @@ def main():
     pic_width = max(original_size[0], final_size[0])
     pic_height = max(original_size[1], final_size[1])
 
-# remove one in every `inc` points to make the lengths equal
-    a = max(original_line, final_line, key=len)
-    b = min(original_line, final_line, key=len)
-    while len(a) != len(b):
-        inc = len(a) / (len(a) - len(b))
-        i = 0.0
-        while i < len(a):             
-            del a[int(i)]
-            if len(a) == len(b):
-                break
-            i += inc
+# pick evenly spaced points on the longer line to make the lengths equal
+    npoints = min(len(original_line), len(final_line))
+    original_line = np.asarray(original_line)[np.linspace(0, len(original_line) - 1, npoints).round().astype(np.int64)]
+    final_line = np.asarray(final_line)[np.linspace(0, len(final_line) - 1, npoints).round().astype(np.int64)]
 
 # interpolate between original_line and final_line
 
-    frames = []
-    for t in np.linspace(0.0, 1.0, nframes):
-        interpolated = []
-        for (i0, j0), (i1, j1) in zip(original_line, final_line):
-            interpolated.append((int(lerp(j0, j1, t)), int(lerp(i0, i1, t))))
-        
-        img = Image.new("RGBA", (pic_width, pic_height), (255, 255, 255, 255))
-        draw = ImageDraw.Draw(img)
-        color = (int(lerp(original_color[0], final_color[0], t)),
-                 int(lerp(original_color[1], final_color[1], t)),
-                 int(lerp(original_color[2], final_color[2], t)),
-                 255)
-
-        for i in range(len(interpolated) - 1):
-            draw.line(interpolated[i - 1] + interpolated[i], fill=color, width=1)
-        draw.line(interpolated[-1] + interpolated[0], fill=color, width=1)
-        flood_fill(img, (interpolated[0][0], interpolated[0][1] + 5), color)
-        frames.append(img)
-
-    if format == Format.GIF:
-        frames[0].save(f'{output_path}',
-               save_all=True, append_images=frames[1:], optimize=True, duration=duration * 1000.0 / nframes, loop=loop)
-    elif format == Format.PNG:
-        for i, frame in enumerate(frames):
-            frame.save(f'{output_path}/{i + 1}.png')
-    elif format == Format.JPEG:
-        for i, frame in enumerate(frames):
-            frame.convert("RGB").save(f'{output_path}/{i + 1}.jpeg')
-    else:
-        eprint('unsupported format')
-        eprint(f'{program}: error: unsupported format `{format}`')
-        exit(1)
+# points are stored as (i, j), so swap them to get (x, y) for drawing
+    start = original_line[:, ::-1].astype(np.int32)
+    delta = final_line[:, ::-1].astype(np.int32) - start
+
+    ts = (np.linspace(0.0, 1.0, nframes) * (1 << FRACTION_BITS)).astype(np.int32)
+    oc = np.array(original_color[:3], dtype=np.int32)
+    fc = np.array(final_color[:3], dtype=np.int32)
+    colors = [tuple(color) for color in (oc + ((fc - oc) * ts[:, None] >> FRACTION_BITS)).tolist()]
+    # hand plain ints to the workers instead of numpy scalars
+    ts = ts.tolist()
+
+# frames are written as soon as they are rendered so that only a few of them are in memory at once
+    render_args = dict(start=start, delta=delta, size=(pic_width, pic_height))
+    with ProcessPoolExecutor() as executor:
+        chunksize = max(1, nframes // (4 * (cpu_count() or 1)))
+        if format == Format.GIF:
+# draw the frames directly with palette indices so that they do not have to be quantized
+            palette = shared_palette(colors)
+            indices = np.asarray(palette)[0].tolist()
+            render = partial(render_frame, mode="P", background=indices[0], palette=palette, **render_args)
+            frames = executor.map(render, ts, indices[1:], chunksize=chunksize)
+            next(frames).save(f'{output_path}',
+                   save_all=True, append_images=frames, optimize=True, duration=duration * 1000.0 / nframes, loop=loop)
+        elif format == Format.PNG:
+            write = partial(write_frame, **render_args)
+            paths = [f'{output_path}/{i + 1}.png' for i in range(nframes)]
+            list(executor.map(write, paths, ts, colors, chunksize=chunksize))
+        elif format == Format.JPEG:
+            write = partial(write_frame, mode="RGB", **render_args)
+            paths = [f'{output_path}/{i + 1}.jpeg' for i in range(nframes)]
+            list(executor.map(write, paths, ts, colors, chunksize=chunksize))
+        else:
+            parser.error(f'unsupported format `{format}`')
 
-    
 
 if __name__ == "__main__":
     main()